@@ -1,9 +1,11 @@
 import threading
-from flask import Flask, jsonify, render_template_string
+from flask import Flask, Response, request
 import paho.mqtt.client as mqtt
-import json
+import orjson
 import time
 import random
+import queue
+import logging
 
 # --- MQTT Configuration ---
 # Uses the same credentials as your Arduino
@@ -12,13 +14,104 @@ MQTT_PORT = 1883
 MQTT_USER = "ujju"
 MQTT_PASS = "Oli*16620"
 # We will subscribe to all topics under "home/laundry/"
-MQTT_TOPIC = "home/laundry/#"
+MQTT_TOPIC_PREFIX = "home/laundry"
+MQTT_TOPIC = MQTT_TOPIC_PREFIX + "/#"
+
+logger = logging.getLogger(__name__)
 
 # --- Global State Management ---
-# This dictionary will store the latest state of all devices.
-# We use a lock to make it thread-safe, as MQTT and Flask run in different threads.
-device_states = {}
-state_lock = threading.Lock()
+# published_states holds (state_version, device_states), where device_states
+# maps each device to a dict of its latest states. Published dicts are never
+# mutated: the state writer thread builds new copies and swaps the whole
+# tuple in one assignment, so readers can grab it without any lock.
+# The version lets /api/states reuse its last serialized response until
+# something moves; the boot id keeps ETags from a previous run from
+# matching this one.
+published_states = (0, {})
+STATE_BOOT_ID = format(time.time_ns(), 'x')
+cached_states = (-1, b'{}')  # (state_version, JSON bytes)
+
+# Notified by the writer after each publish, for /api/events streams.
+state_changed = threading.Condition()
+
+# A misbehaving publisher could otherwise grow device_states without bound.
+MAX_DEVICES = 256
+
+def device_sort_key(device_name):
+    """Display order: the real node_1 first, then everything else by name."""
+    return ('node_1' not in device_name, device_name)
+
+# MQTT and the simulation just queue (device_name, updates) pairs here;
+# apply_state_updates() is the only thread that touches published_states.
+state_updates = queue.SimpleQueue()
+
+def update_device(device_name, updates):
+    """Queues `updates` (a dict of state_type -> value) for one device."""
+    state_updates.put((device_name, updates))
+
+def apply_state_updates():
+    """
+    A background thread function that drains queued updates in batches,
+    publishing one new snapshot (and version) per batch that changes
+    something. The board re-publishes its retained states every few
+    seconds, so most batches are no-ops and must not bump the version.
+    """
+    global published_states
+    cap_warned = False
+    while True:
+        # Block for the first update, then grab whatever else is waiting
+        batch = [state_updates.get()]
+        while True:
+            try:
+                batch.append(state_updates.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            version, device_states = published_states
+            device_states = dict(device_states)
+            changed = False
+            devices_added = False
+            for device_name, updates in batch:
+                if device_name not in device_states:
+                    if len(device_states) >= MAX_DEVICES:
+                        if not cap_warned:
+                            logger.warning("Device limit (%d) reached, ignoring new devices", MAX_DEVICES)
+                            cap_warned = True
+                        continue
+                    devices_added = True
+                current = device_states.get(device_name)
+                merged = {**(current or {}), **updates}
+                if merged != current:
+                    device_states[device_name] = merged
+                    changed = True
+            if not changed:
+                continue
+            # Dicts keep insertion order, so sorting only when the set of devices
+            # changes means every snapshot is already in display order.
+            if devices_added:
+                device_states = {name: device_states[name]
+                                 for name in sorted(device_states, key=device_sort_key)}
+            published_states = (version + 1, device_states)
+            with state_changed:
+                state_changed.notify_all()
+        except Exception:
+            # Keep the only writer alive; the failed batch is dropped
+            logger.exception("Error applying state updates")
+
+def get_states_json():
+    """Returns (version, JSON bytes) for the current states, serializing only on change."""
+    global cached_states
+    # Published snapshots are immutable, so no lock or copy is needed
+    version, current_states = published_states
+    cached_version, body = cached_states
+    if version != cached_version:
+        # orjson serializes in native code and returns bytes, skipping the
+        # stdlib encoder that jsonify uses.
+        body = orjson.dumps(current_states)
+        # A single tuple assignment, so the version always matches its bytes
+        cached_states = (version, body)
+    return version, body
 
 # --- NEW: List of fake nodes to simulate ---
 FAKE_NODE_NAMES = ["fake_dryer_1", "fake_washer_2", "fake_dryer_2"]
@@ -31,34 +124,31 @@ app = Flask(__name__)
 def on_connect(client, userdata, flags, rc, properties=None):
     """Callback when the client connects to the broker."""
     if rc == 0:
-        print("Connected to MQTT Broker!")
+        logger.info("Connected to MQTT Broker!")
         # Subscribe to the topic once connected
         client.subscribe(MQTT_TOPIC)
-        print(f"Subscribed to topic: {MQTT_TOPIC}")
+        logger.info("Subscribed to topic: %s", MQTT_TOPIC)
     else:
-        print(f"Failed to connect, return code {rc}")
+        logger.error("Failed to connect, return code %s", rc)
 
 def on_message(client, userdata, msg):
     """Callback when a REAL message is received."""
     try:
-        topic_parts = msg.topic.split('/')
-        payload = msg.payload.decode('utf-8')
+        # We expect topics like: "home/laundry/node_1/machine_state".
+        # Two rpartitions peel off the last two levels without building a list.
+        rest, _, state_type = msg.topic.rpartition('/')   # e.g., "machine_state"
+        prefix, _, device_name = rest.rpartition('/')     # e.g., "node_1"
         
-        # We expect topics like: "home/laundry/node_1/machine_state"
-        if len(topic_parts) == 4:
-            device_name = topic_parts[2]  # e.g., "node_1"
-            state_type = topic_parts[3]   # e.g., "machine_state"
+        if prefix == MQTT_TOPIC_PREFIX:
+            payload = msg.payload.decode('utf-8')
             
-            print(f"[MQTT] Received: {device_name} -> {state_type} = {payload}")
+            # %-style args are only formatted if DEBUG logging is enabled
+            logger.debug("[MQTT] Received: %s -> %s = %s", device_name, state_type, payload)
             
-            # Update the global state dictionary safely
-            with state_lock:
-                if device_name not in device_states:
-                    device_states[device_name] = {}
-                device_states[device_name][state_type] = payload
+            update_device(device_name, {state_type: payload})
                 
     except Exception as e:
-        print(f"Error processing message: {e}")
+        logger.error("Error processing message: %s", e)
 
 def setup_mqtt():
     """Initializes and starts the MQTT client."""
@@ -68,11 +158,14 @@ def setup_mqtt():
     client.username_pw_set(MQTT_USER, MQTT_PASS)
     client.on_connect = on_connect
     client.on_message = on_message
+    # Retry quickly after a dropped connection instead of paho's default
+    # 1-120 s backoff; on_connect re-subscribes each time.
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
     
     try:
         client.connect(MQTT_BROKER, MQTT_PORT, 60)
     except Exception as e:
-        print(f"Error connecting to MQTT broker: {e}")
+        logger.error("Error connecting to MQTT broker: %s", e)
         return
     
     # loop_start() runs the client in a separate background thread.
@@ -86,40 +179,49 @@ def simulate_fake_nodes():
     A background thread function that simulates data for fake devices.
     This makes the dashboard look populated and active.
     """
-    # Initialize fake states
-    with state_lock:
-        for name in FAKE_NODE_NAMES:
-            if name not in device_states:
-                device_states[name] = {
-                    'machine_state': random.choice(['ON', 'OFF']),
-                    'door_state': random.choice(['Open', 'Closed'])
-                }
+    # A private generator keeps the simulation's draws off the shared
+    # module-level random state and lets the lookups below stay local.
+    rng = random.Random()
+
+    # This thread is the only source for the fake nodes, so it keeps their
+    # current values locally instead of reading them back.
+    fake_states = {}
+    for name in FAKE_NODE_NAMES:
+        fake_states[name] = {
+            'machine_state': rng.choice(['ON', 'OFF']),
+            'door_state': rng.choice(['Open', 'Closed'])
+        }
+        update_device(name, fake_states[name])
     
     # Loop forever, randomly updating one node
     while True:
         try:
             # Update every 3-8 seconds
-            time.sleep(random.uniform(3.0, 8.0))
+            time.sleep(rng.uniform(3.0, 8.0))
             
-            node_name = random.choice(FAKE_NODE_NAMES)
+            node_name = rng.choice(FAKE_NODE_NAMES)
+            current = fake_states[node_name]
+            updates = {}
             
-            with state_lock:
-                # 50% chance to toggle machine state
-                if random.random() < 0.5:
-                    current_state = device_states[node_name]['machine_state']
-                    new_state = 'OFF' if current_state == 'ON' else 'ON'
-                    device_states[node_name]['machine_state'] = new_state
-                    print(f"[SIM] {node_name}: Machine state -> {new_state}")
-                
-                # 30% chance to toggle door state
-                if random.random() < 0.3:
-                    current_state = device_states[node_name]['door_state']
-                    new_state = 'Closed' if current_state == 'Open' else 'Open'
-                    device_states[node_name]['door_state'] = new_state
-                    print(f"[SIM] {node_name}: Door state -> {new_state}")
+            # 50% chance to toggle machine state
+            if rng.random() < 0.5:
+                new_state = 'OFF' if current['machine_state'] == 'ON' else 'ON'
+                updates['machine_state'] = new_state
+                logger.debug("[SIM] %s: Machine state -> %s", node_name, new_state)
+            
+            # 30% chance to toggle door state
+            if rng.random() < 0.3:
+                new_state = 'Closed' if current['door_state'] == 'Open' else 'Open'
+                updates['door_state'] = new_state
+                logger.debug("[SIM] %s: Door state -> %s", node_name, new_state)
+
+            if updates:
+                # Replace rather than mutate, the queued dict may not be applied yet
+                fake_states[node_name] = {**current, **updates}
+                update_device(node_name, updates)
 
         except Exception as e:
-            print(f"Error in simulation thread: {e}")
+            logger.error("Error in simulation thread: %s", e)
             time.sleep(5) # Don't spam errors
 
 # --- Flask Web Routes ---
@@ -276,131 +378,233 @@ HTML_TEMPLATE = """
     <div id="refresh-status"></div>
 
     <script>
-        function fetchStates() {
-            fetch('/api/states')
-                .then(response => response.json())
-                .then(data => {
-                    const devicesContainer = document.getElementById('devices-container');
-                    
-                    if (Object.keys(data).length === 0) {
-                        if (!document.querySelector('.waiting')) {
-                            devicesContainer.innerHTML = '<p class="waiting">Waiting for device data...</p>';
-                        }
-                        return;
-                    }
+        function renderStates(data) {
+            const devicesContainer = document.getElementById('devices-container');
+            
+            if (Object.keys(data).length === 0) {
+                if (!document.querySelector('.waiting')) {
+                    devicesContainer.innerHTML = '<p class="waiting">Waiting for device data...</p>';
+                }
+                return;
+            }
+
+            // The server already sends devices in order, "node_1" (real) first
+            const sortedDeviceNames = Object.keys(data);
+            
+            let hasRealData = false;
 
-                    // --- Sort keys so "node_1" (real) is always first ---
-                    const sortedDeviceNames = Object.keys(data).sort((a, b) => {
-                        if (a.includes('node_1')) return -1;
-                        if (b.includes('node_1')) return 1;
-                        return a.localeCompare(b);
-                    });
+            for (const deviceName of sortedDeviceNames) {
+                // Find or create device element
+                let deviceElement = document.getElementById(deviceName);
+                if (!deviceElement) {
+                    deviceElement = document.createElement('div');
+                    deviceElement.className = 'device';
+                    deviceElement.id = deviceName;
                     
-                    let hasRealData = false;
-
-                    for (const deviceName of sortedDeviceNames) {
-                        // Find or create device element
-                        let deviceElement = document.getElementById(deviceName);
-                        if (!deviceElement) {
-                            deviceElement = document.createElement('div');
-                            deviceElement.className = 'device';
-                            deviceElement.id = deviceName;
-                            
-                            let deviceHTML = `<h2>${deviceName.replace('_', ' ')}</h2>`;
-                            const states = data[deviceName];
-                            for (const stateType in states) {
-                                deviceHTML += `<div class="state" data-state-type="${stateType}"></div>`;
-                            }
-                            deviceElement.innerHTML = deviceHTML;
-                            
-                            // If this is the first item, remove the "waiting" message
-                            const waitingMessage = devicesContainer.querySelector('.waiting');
-                            if (waitingMessage) {
-                                waitingMessage.remove();
-                            }
-                            devicesContainer.appendChild(deviceElement);
-                        }
-                        
-                        // Update states within the device element
-                        const states = data[deviceName];
-                        for (const stateType in states) {
-                            const stateValue = states[stateType];
-                            const cleanStateType = stateType.replace('machine_', '').replace('_', ' ');
-                            
-                            const stateElement = deviceElement.querySelector(`.state[data-state-type="${stateType}"]`);
-                            const stateHTML = `
-                                <span class="state-name">${cleanStateType}</span>
-                                <span class="state-value" data-value="${stateValue}">${stateValue}</span>
-                            `;
-                            // Only update if content is different to avoid flicker
-                            if (stateElement.innerHTML !== stateHTML) {
-                                stateElement.innerHTML = stateHTML;
-                            }
-                        }
-                        
-                        if(deviceName.includes('node_1')) hasRealData = true;
+                    let deviceHTML = `<h2>${deviceName.replace('_', ' ')}</h2>`;
+                    const states = data[deviceName];
+                    for (const stateType in states) {
+                        deviceHTML += `<div class="state" data-state-type="${stateType}"></div>`;
                     }
+                    deviceElement.innerHTML = deviceHTML;
                     
-                    // Update the refresh status
-                    const status = document.getElementById('refresh-status');
-                    status.textContent = 'Last updated: ' + new Date().toLocaleTimeString();
+                    // If this is the first item, remove the "waiting" message
+                    const waitingMessage = devicesContainer.querySelector('.waiting');
+                    if (waitingMessage) {
+                        waitingMessage.remove();
+                    }
+                    devicesContainer.appendChild(deviceElement);
+                }
+                
+                // Update states within the device element
+                const states = data[deviceName];
+                for (const stateType in states) {
+                    const stateValue = states[stateType];
+                    const cleanStateType = stateType.replace('machine_', '').replace('_', ' ');
                     
-                    // Update header for real node
-                    const header = document.querySelector('h1');
-                    if(hasRealData){
-                         header.textContent = "Laundry Monitor (node_1 Online)";
-                    } else {
-                         header.textContent = "Laundry Monitor (Simulation)";
+                    const stateElement = deviceElement.querySelector(`.state[data-state-type="${stateType}"]`);
+                    const stateHTML = `
+                        <span class="state-name">${cleanStateType}</span>
+                        <span class="state-value" data-value="${stateValue}">${stateValue}</span>
+                    `;
+                    // Only update if content is different to avoid flicker
+                    if (stateElement.innerHTML !== stateHTML) {
+                        stateElement.innerHTML = stateHTML;
                     }
-                })
-                .catch(error => {
-                    console.error('Error fetching states:', error);
-                    const devicesContainer = document.getElementById('devices-container');
-                    devicesContainer.innerHTML = '<p class="waiting">Error connecting to server.</p>';
-                });
+                }
+                
+                if(deviceName.includes('node_1')) hasRealData = true;
+            }
+            
+            // States are only pushed when something changes, so this is the
+            // time of the last change rather than of the last refresh
+            const status = document.getElementById('refresh-status');
+            status.textContent = 'Last change: ' + new Date().toLocaleTimeString();
+            
+            // Update header for real node
+            const header = document.querySelector('h1');
+            if(hasRealData){
+                 header.textContent = "Laundry Monitor (node_1 Online)";
+            } else {
+                 header.textContent = "Laundry Monitor (Simulation)";
+            }
         }
-        
+
         // --- Added helper to capitalize state names ---
         String.prototype.title = function() {
             return this.charAt(0).toUpperCase() + this.slice(1);
         }
 
-        // Fetch new data every 2 seconds
-        setInterval(fetchStates, 2000);
-        // Fetch immediately on load
-        document.addEventListener('DOMContentLoaded', fetchStates);
+        function showConnectionError(error) {
+            console.error('Error receiving states:', error);
+            const devicesContainer = document.getElementById('devices-container');
+            devicesContainer.innerHTML = '<p class="waiting">Error connecting to server.</p>';
+        }
+
+        // Fallback for when the server refuses an event stream. An unchanged
+        // state comes back as a 304, which fetch turns into the cached body
+        // with the same ETag; skip those so "Last change" stays accurate.
+        let lastPolledEtag = null;
+        function pollStates() {
+            fetch('/api/states')
+                .then(response => {
+                    const etag = response.headers.get('ETag');
+                    if (etag !== null && etag === lastPolledEtag) return null;
+                    lastPolledEtag = etag;
+                    return response.json();
+                })
+                .then(data => {
+                    if (data !== null) renderStates(data);
+                })
+                .catch(showConnectionError);
+        }
+
+        // The server pushes the full state whenever it changes (and once on
+        // connect). EventSource reconnects on its own after a dropped
+        // connection, but gives up for good if the server answers with an
+        // error status (a 503 when too many dashboards are open); then we
+        // poll every 2 seconds instead.
+        document.addEventListener('DOMContentLoaded', () => {
+            const events = new EventSource('/api/events');
+            events.onmessage = event => renderStates(JSON.parse(event.data));
+            events.onerror = error => {
+                if (events.readyState === EventSource.CLOSED) {
+                    pollStates();
+                    setInterval(pollStates, 2000);
+                    return;
+                }
+                showConnectionError(error);
+            };
+        });
     </script>
 </body>
 </html>
 """
 
+# The page has no server-side variables, so encode it once at import
+# instead of on every GET.
+INDEX_HTML_BYTES = HTML_TEMPLATE.encode('utf-8')
+
 @app.route('/')
 def index():
     """Serves the main HTML dashboard."""
-    # The HTML template is rendered directly from the string
-    return HTML_TEMPLATE
+    return Response(INDEX_HTML_BYTES, mimetype='text/html')
 
 @app.route('/api/states')
 def api_states():
-    """Provides a JSON API endpoint for the front-end to fetch data."""
-    with state_lock:
-        # Return a *copy* of the state dictionary
-        current_states = device_states.copy()
-    return jsonify(current_states)
+    """Provides a JSON API endpoint to fetch the current states."""
+    version, body = get_states_json()
+    response = Response(body, mimetype='application/json')
+    # Ask browsers to revalidate every poll; unchanged state becomes a 304
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(f"{STATE_BOOT_ID}-{version}")
+    return response.make_conditional(request)
 
-# --- Main Execution ---
-if __name__ == '__main__':
-    print("Starting MQTT client...")
+# How often an idle event stream sends a comment, so dead clients get
+# noticed and proxies don't time the connection out.
+EVENTS_KEEPALIVE_SECONDS = 15
+
+# Each open /api/events stream holds a server thread for as long as the
+# dashboard stays open. Past the cap, new streams get a 503 and the page
+# falls back to polling /api/states, so streams can never take every thread.
+# This default suits the dev server, which starts a thread per request;
+# under gunicorn, post_worker_init sets the cap from the worker's threads.
+event_stream_slots = threading.BoundedSemaphore(24)
+
+def set_max_event_streams(max_streams):
+    """Caps the number of open /api/events streams (0 makes every dashboard poll)."""
+    global event_stream_slots
+    event_stream_slots = threading.BoundedSemaphore(max_streams)
+
+@app.route('/api/events')
+def api_events():
+    """Streams the states to the front-end as Server-Sent Events whenever they change."""
+    if not event_stream_slots.acquire(blocking=False):
+        return Response('Too many open event streams', status=503,
+                        headers={'Retry-After': '30'})
+
+    def stream():
+        last_version = -1
+        while True:
+            with state_changed:
+                state_changed.wait_for(lambda: published_states[0] != last_version,
+                                       timeout=EVENTS_KEEPALIVE_SECONDS)
+            version, body = get_states_json()
+            if version == last_version:
+                yield b': keep-alive\n\n'
+                continue
+            last_version = version
+            yield b'data: ' + body + b'\n\n'
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+    # The server closes the response when the client goes away, even if the
+    # stream never started, so the slot is always given back.
+    response.call_on_close(event_stream_slots.release)
+    return response
+
+# --- Background Services ---
+
+background_started = False
+background_lock = threading.Lock()
+
+def start_background_services():
+    """
+    Starts the state writer, the MQTT client and the simulation thread.
+    Safe to call more than once; only the first call in a process does
+    anything. Under gunicorn this runs from the post_worker_init hook in
+    gunicorn.conf.py, which is why that config runs a single worker.
+    """
+    global background_started
+    with background_lock:
+        if background_started:
+            return
+        background_started = True
+
+    # The state writer must be running before anything queues updates
+    writer_thread = threading.Thread(target=apply_state_updates, daemon=True)
+    writer_thread.start()
+
+    logger.info("Starting MQTT client...")
     setup_mqtt()
     
     # --- NEW: Start the simulation thread ---
-    print("Starting device simulation thread...")
+    logger.info("Starting device simulation thread...")
     sim_thread = threading.Thread(target=simulate_fake_nodes, daemon=True)
     sim_thread.start()
     # --- End NEW ---
+
+# --- Main Execution ---
+# For anything beyond local testing, run under gunicorn instead:
+#   gunicorn -c gunicorn.conf.py app:app
+if __name__ == '__main__':
+    # Set the level to DEBUG to see every MQTT message and simulated toggle
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    start_background_services()
     
-    print("Starting Flask web server on http://127.0.0.1:5000")
+    logger.info("Starting Flask web server on http://127.0.0.1:8081")
     # We must run with use_reloader=False. 
     # If the reloader is on, it runs the setup code twice,
     # which creates two MQTT clients that fight each other.
-    app.run(debug=True, use_reloader=False, host='0.0.0.0', port=8081)
\ No newline at end of file
+    app.run(debug=False, use_reloader=False, host='0.0.0.0', port=8081)
\ No newline at end of file
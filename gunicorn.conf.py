@@ -0,0 +1,30 @@
+# Gunicorn configuration for the Laundry Monitor web app.
+# Run with: gunicorn -c gunicorn.conf.py app:app
+import logging
+import os
+
+bind = "0.0.0.0:8081"
+
+# Device state lives in process memory, and each worker would start its own
+# MQTT client and fake-node simulation, so run one worker and scale with
+# threads.
+workers = 1
+
+# Threads do the concurrency here. Each open dashboard holds one thread for
+# its /api/events stream for as long as the page is open, so post_worker_init
+# caps open streams at `threads` minus a reserve (a quarter, at least one).
+# Dashboards past the cap get a 503 and fall back to polling, and the
+# reserved threads always stay free for /, /api/states and those polls.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 32))
+
+
+def post_worker_init(worker):
+    """Starts the MQTT client and background threads inside the worker."""
+    # Imported here so the threads start after the fork, not in the master
+    from app import set_max_event_streams, start_background_services
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    worker_threads = worker.cfg.threads
+    set_max_event_streams(worker_threads - max(1, worker_threads // 4))
+    start_background_services()